@@ -1,10 +1,11 @@
 import os
+import asyncio
+import functools
+import aiohttp
 import psycopg
 from datetime import datetime, timezone
-from mattermostdriver import Driver
 from dotenv import load_dotenv
 import logging
-import time
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
@@ -22,22 +23,137 @@ PG_PORT = os.getenv("PG_PORT")
 PG_USER = os.getenv("PG_USER")
 PG_PASSWORD = os.getenv("PG_PASSWORD")
 PG_DB = os.getenv("PG_DB")
-
-# Configurable API delay
-API_DELAY = float(os.getenv("API_DELAY", "0.001"))
-BATCH_SIZE = int(os.getenv("BATCH_SIZE", "100")) # Add BATCH_SIZE configuration
-
-def get_mattermost_driver():
-    return Driver({
-        'url': MM_URL,
-        'login_id': MM_USER,
-        'password': MM_PASSWORD,
-        'scheme': 'https',
-        'port': 443,
-        'verify': True,
-        'debug': False,
-        'timeout': 30,
-    })
+PG_SSLMODE = os.getenv("PG_SSLMODE", "prefer")
+PG_CONNECT_TIMEOUT = int(os.getenv("PG_CONNECT_TIMEOUT", "10"))
+
+# Mattermost API rate limit in requests per second, and the burst allowed on top.
+# The burst is lowered automatically to the server's advertised burst; pacing
+# also follows X-Ratelimit-Remaining/-Reset and Retry-After on 429 responses.
+API_RATE_LIMIT = float(os.getenv("API_RATE_LIMIT", "50"))
+API_BURST = int(os.getenv("API_BURST", "50"))
+# Maximum number of concurrent Mattermost API requests
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "64"))
+# Retries per Mattermost API request, with exponential backoff starting at RETRY_BACKOFF seconds
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
+RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", "0.5"))
+# Response statuses worth retrying; other client errors (e.g. 403 on a channel) won't succeed on retry
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Seconds an idle keep-alive connection to Mattermost is kept open for reuse
+KEEPALIVE_TIMEOUT = float(os.getenv("KEEPALIVE_TIMEOUT", "60"))
+# User ids per bulk status/user lookup request, and how many of those may run at once
+USER_ID_CHUNK_SIZE = 100
+USER_ID_CHUNK_CONCURRENCY = 8
+# How records are written: 'copy' (fastest) or 'values' (multi-row INSERT, for setups where COPY is not allowed)
+INSERT_MODE = os.getenv("INSERT_MODE", "copy").lower()
+# Rows per multi-row INSERT statement when INSERT_MODE is 'values'.
+# Postgres allows at most 65535 bind parameters per statement, at 8 per row.
+MAX_INSERT_CHUNK_SIZE = 65535 // 8
+INSERT_CHUNK_SIZE = int(os.getenv("INSERT_CHUNK_SIZE", "1000"))
+if not 1 <= INSERT_CHUNK_SIZE <= MAX_INSERT_CHUNK_SIZE:
+    logging.warning("INSERT_CHUNK_SIZE=%d is outside 1..%d, clamping.", INSERT_CHUNK_SIZE, MAX_INSERT_CHUNK_SIZE)
+    INSERT_CHUNK_SIZE = min(max(INSERT_CHUNK_SIZE, 1), MAX_INSERT_CHUNK_SIZE)
+
+def get_mattermost_api_url():
+    # Accept both a bare hostname and a full URL with scheme
+    base_url = MM_URL if "://" in MM_URL else f"https://{MM_URL}"
+    return f"{base_url.rstrip('/')}/api/v4"
+
+class RateLimiter:
+    """Token bucket shared by all requests, tuned by X-Ratelimit-* response headers."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = None
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        if self._updated is not None:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                now = loop.time()
+            self._refill(now)
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill(loop.time())
+            self._tokens -= 1
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, asyncio.get_running_loop().time() + seconds)
+
+    def update_from_headers(self, headers):
+        # Mattermost's limiter reports its burst size plus one as the limit, the
+        # requests remaining in the current burst, and the seconds until it resets.
+        try:
+            limit = headers.get('X-Ratelimit-Limit')
+            if limit is not None and 0 < int(limit) - 1 < self.capacity:
+                self.capacity = int(limit) - 1
+                logging.info("Lowering API burst to %d requests as advertised by the server.", self.capacity)
+            remaining = headers.get('X-Ratelimit-Remaining')
+            if remaining is not None:
+                # Never assume more headroom than the server still grants
+                self._tokens = min(self._tokens, float(remaining))
+                reset = headers.get('X-Ratelimit-Reset')
+                if int(remaining) <= 0 and reset is not None:
+                    self.pause(float(reset))
+        except ValueError:
+            pass
+
+class MattermostClient:
+    """Minimal async client for the Mattermost REST API v4."""
+
+    def __init__(self, session, api_url):
+        self.session = session
+        self.api_url = api_url
+        self.token = None
+        self.user_id = None
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        self.rate_limiter = RateLimiter(API_RATE_LIMIT, API_BURST)
+
+    async def _send(self, method, path, **kwargs):
+        headers = {'Authorization': f"Bearer {self.token}"} if self.token else {}
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                async with self.semaphore:
+                    await self.rate_limiter.acquire()
+                    async with self.session.request(method, f"{self.api_url}{path}", headers=headers, **kwargs) as resp:
+                        self.rate_limiter.update_from_headers(resp.headers)
+                        if resp.status == 429:
+                            # Hold back every task, not just this one, until the server allows requests again
+                            try:
+                                self.rate_limiter.pause(float(resp.headers.get('Retry-After', RETRY_BACKOFF)))
+                            except ValueError:
+                                self.rate_limiter.pause(RETRY_BACKOFF)
+                        resp.raise_for_status()
+                        return await resp.json(), resp.headers
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == MAX_RETRIES or (isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRY_STATUSES):
+                    raise
+                delay = RETRY_BACKOFF * 2 ** attempt
+                logging.warning("%s %s failed (%s), retrying in %.2fs.", method, path, e, delay)
+                await asyncio.sleep(delay)
+
+    async def request(self, method, path, **kwargs):
+        body, _ = await self._send(method, path, **kwargs)
+        return body
+
+    async def login(self):
+        user, headers = await self._send('POST', '/users/login', json={'login_id': MM_USER, 'password': MM_PASSWORD})
+        self.token = headers['Token']
+        self.user_id = user['id']
+
+    async def logout(self):
+        await self.request('POST', '/users/logout')
+        self.token = None
 
 def get_pg_conn():
     return psycopg.connect(
@@ -45,49 +161,173 @@ def get_pg_conn():
         port=PG_PORT,
         user=PG_USER,
         password=PG_PASSWORD,
-        dbname=PG_DB
+        dbname=PG_DB,
+        sslmode=PG_SSLMODE,
+        connect_timeout=PG_CONNECT_TIMEOUT,
+        # The script runs as a one-shot per collection, so a pool would not
+        # outlive the process; keepalives guard the single connection instead.
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=3,
     )
 
-def ensure_table_exists(conn):
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS channel_user_status (
+    id SERIAL,
+    timestamp TIMESTAMPTZ NOT NULL,
+    team_id TEXT NOT NULL,
+    team_name TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    channel_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (id, timestamp)
+);
+"""
+
+CREATE_HYPERTABLE_SQL = "SELECT create_hypertable('channel_user_status', 'timestamp', if_not_exists => TRUE);"
+
+# Segment by columns that are often filtered together or define logical groups.
+# The compressed-chunk index follows this order, so the column queried most
+# (the dashboard partitions and filters by user_id) comes first.
+# Order by timestamp for efficient compression and querying of recent (uncompressed) data.
+COMPRESS_SEGMENTBY = "user_id, channel_id, team_id"
+COMPRESS_ORDERBY = "timestamp ASC"
+COMPRESSION_SETTINGS_SQL = f"""
+ALTER TABLE channel_user_status
+SET (
+    timescaledb.compress = 'on',
+    timescaledb.compress_segmentby = '{COMPRESS_SEGMENTBY}',
+    timescaledb.compress_orderby = '{COMPRESS_ORDERBY}'
+);
+"""
+
+# Compress data older than 1 day. Adjust the interval as needed for your use case.
+COMPRESSION_POLICY_SQL = "SELECT add_compression_policy('channel_user_status', INTERVAL '1 days', if_not_exists => TRUE);"
+
+# Bump whenever the DDL above changes, so existing databases get it re-applied
+SCHEMA_VERSION = 2
+SCHEMA_VERSION_COMMENT = f"schema_version={SCHEMA_VERSION}"
+
+def schema_is_current(conn):
+    # The table comment records which schema version was last applied in full
     with conn.cursor() as cur:
-        # Ensure TimescaleDB extension is available
-        # Note: Creating the extension might require superuser privileges
-        # and might be better handled as a one-time manual setup in the database.
-        try:
+        cur.execute("SELECT obj_description(to_regclass('channel_user_status'), 'pg_class');")
+        row = cur.fetchone()
+    return row is not None and row[0] == SCHEMA_VERSION_COMMENT
+
+def set_schema_version(cur):
+    cur.execute(f"COMMENT ON TABLE channel_user_status IS '{SCHEMA_VERSION_COMMENT}';")
+
+def compression_settings_match(conn):
+    # Re-running the ALTER is not free and fails outright once compressed
+    # chunks exist, so only issue it when the settings actually differ.
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+            SELECT attname, segmentby_column_index, orderby_column_index, orderby_asc
+            FROM timescaledb_information.compression_settings
+            WHERE hypertable_schema = current_schema() AND hypertable_name = 'channel_user_status';
+            """)
+            rows = cur.fetchall()
+    except psycopg.Error as e:
+        # Extension or table missing: nothing is configured yet
+        logging.debug("Could not read compression settings: %s", e)
+        return False
+
+    segmentby = [attname for attname, idx, _, _ in sorted((r for r in rows if r[1] is not None), key=lambda r: r[1])]
+    orderby = [f"{attname} {'ASC' if asc else 'DESC'}" for attname, _, idx, asc in sorted((r for r in rows if r[2] is not None), key=lambda r: r[2])]
+    return ", ".join(segmentby) == COMPRESS_SEGMENTBY and ", ".join(orderby) == COMPRESS_ORDERBY
+
+def has_compressed_chunks(conn):
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM timescaledb_information.chunks
+                WHERE hypertable_schema = current_schema() AND hypertable_name = 'channel_user_status' AND is_compressed
+            );
+            """)
+            return cur.fetchone()[0]
+    except psycopg.Error as e:
+        logging.debug("Could not check for compressed chunks: %s", e)
+        return False
+
+def ensure_extension_exists(conn):
+    # Ensure TimescaleDB extension is available
+    # Note: Creating the extension might require superuser privileges
+    # and might be better handled as a one-time manual setup in the database.
+    try:
+        with conn.cursor() as cur:
             cur.execute("CREATE EXTENSION IF NOT EXISTS timescaledb CASCADE;")
-            logging.info("TimescaleDB extension ensured.")
+        logging.info("TimescaleDB extension ensured.")
+    except psycopg.Error as e:
+        logging.warning("Could not ensure TimescaleDB extension (this might be fine if already enabled or due to permissions): %s", e)
+
+def ensure_table_exists(conn):
+    # DDL runs in autocommit: CREATE EXTENSION doesn't work inside a user
+    # transaction on some managed Postgres flavors, and a failing statement
+    # can't leave an aborted transaction behind that needs rolling back.
+    conn.autocommit = True
+    try:
+        if schema_is_current(conn):
+            logging.info("Table 'channel_user_status' is at schema version %d, skipping setup.", SCHEMA_VERSION)
+            return
+
+        ensure_extension_exists(conn)
+        apply_compression_settings = not compression_settings_match(conn)
+        if apply_compression_settings and has_compressed_chunks(conn):
+            # TimescaleDB rejects changing segmentby/orderby while compressed
+            # chunks exist. Keep the current settings and record the schema
+            # version anyway, so this is only reported once.
+            logging.warning(
+                "Compression settings of 'channel_user_status' differ from segmentby '%s' / orderby '%s', "
+                "but compressed chunks exist and TimescaleDB cannot reconfigure them. Keeping the current settings; "
+                "see 'Changing compression settings' in the README to migrate manually.",
+                COMPRESS_SEGMENTBY, COMPRESS_ORDERBY,
+            )
+            apply_compression_settings = False
+
+        # Send all idempotent DDL back-to-back in a single pipeline sync, so setup
+        # costs one round-trip instead of one per statement.
+        try:
+            with conn.pipeline():
+                with conn.cursor() as cur:
+                    cur.execute(CREATE_TABLE_SQL)
+                    cur.execute(CREATE_HYPERTABLE_SQL)
+                    if apply_compression_settings:
+                        cur.execute(COMPRESSION_SETTINGS_SQL)
+                    cur.execute(COMPRESSION_POLICY_SQL)
+                    set_schema_version(cur)
+            logging.info("Table 'channel_user_status' schema, hypertable and compression ensured.")
+            return
         except psycopg.Error as e:
-            logging.warning(f"Could not ensure TimescaleDB extension (this might be fine if already enabled or due to permissions): {e}")
-            # If the extension creation fails due to permissions, we might need to rollback
-            # any transaction started by the CREATE EXTENSION command.
-            # However, psycopg2/3 in autocommit mode (default for DDL like CREATE EXTENSION)
-            # might not require this, or if not in autocommit, the 'with conn:' block handles it.
-            # For safety, if an error occurs, we can try to rollback.
-            try:
-                conn.rollback() # Attempt to rollback if in a transaction block
-            except psycopg.Error as rb_e:
-                logging.warning(f"Rollback attempt failed: {rb_e}")
-
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS channel_user_status (
-            id SERIAL,
-            timestamp TIMESTAMPTZ NOT NULL,
-            team_id TEXT NOT NULL,
-            team_name TEXT NOT NULL,
-            channel_id TEXT NOT NULL,
-            channel_name TEXT NOT NULL,
-            user_id TEXT NOT NULL,
-            username TEXT NOT NULL,
-            status TEXT NOT NULL,
-            PRIMARY KEY (id, timestamp)
-        );
-        """)
+            # PipelineAborted or the first failing statement's error; retry
+            # statement by statement to find and handle the DDL that failed.
+            logging.warning("Pipelined schema setup failed, falling back to per-statement setup: %s", e)
+
+        if ensure_table_exists_per_statement(conn, apply_compression_settings):
+            # Only already-set errors occurred, so the schema is as current as
+            # it gets; record that instead of repeating the fallback every run.
+            with conn.cursor() as cur:
+                set_schema_version(cur)
+        else:
+            logging.warning("Schema setup for 'channel_user_status' is incomplete and will be retried on the next run.")
+    finally:
+        conn.autocommit = False
+
+def ensure_table_exists_per_statement(conn, apply_compression_settings):
+    """Run the schema DDL one statement at a time; returns False if any statement failed unexpectedly."""
+    complete = True
+    with conn.cursor() as cur:
+        cur.execute(CREATE_TABLE_SQL)
         logging.info("Table 'channel_user_status' schema ensured.")
 
         # Convert to hypertable if not already one
         try:
-            cur.execute("SELECT create_hypertable('channel_user_status', 'timestamp', if_not_exists => TRUE);")
+            cur.execute(CREATE_HYPERTABLE_SQL)
             logging.info("Table 'channel_user_status' converted to hypertable or already is one.")
         except psycopg.Error as e:
             # Error code '42P07' is for 'duplicate_table' which create_hypertable can return if already a hypertable
@@ -97,153 +337,269 @@ def ensure_table_exists(conn):
             elif 'already a hypertable' in str(e).lower(): # Check string for safety
                  logging.info("Table 'channel_user_status' is already a hypertable (detected by error string).")
             else:
-                logging.error(f"Error converting table to hypertable: {e}")
-                conn.rollback() # Rollback on error
+                logging.error("Error converting table to hypertable: %s", e)
                 raise # Re-raise the exception to stop further processing if hypertable conversion fails
 
-        # Set compression settings
-        # Segment by columns that are often filtered together or define logical groups.
-        # Order by timestamp for efficient compression and querying of recent (uncompressed) data.
-        try:
-            cur.execute("""
-            ALTER TABLE channel_user_status
-            SET (
-                timescaledb.compress = 'on',
-                timescaledb.compress_segmentby = 'team_id, channel_id, user_id',
-                timescaledb.compress_orderby = 'timestamp DESC'
-            );
-            """)
-            logging.info("Compression settings applied to 'channel_user_status'.")
-        except psycopg.Error as e:
-            # It's possible this fails if already set or if there's an issue with the columns.
-            # TimescaleDB might not raise an error if settings are already identical.
-            logging.warning(f"Could not apply compression settings (this might be fine if already set): {e}")
-            conn.rollback() # Rollback on error
-
-        # Add compression policy to compress data older than, for example, 7 days
-        # Adjust the interval as needed for your use case.
+        # Set compression settings, unless they already match
+        if apply_compression_settings:
+            try:
+                cur.execute(COMPRESSION_SETTINGS_SQL)
+                logging.info("Compression settings applied to 'channel_user_status'.")
+            except psycopg.Error as e:
+                # Settings that are already identical were detected up front,
+                # so this is an issue with the columns or permissions.
+                logging.warning("Could not apply compression settings: %s", e)
+                complete = False
+
+        # Add compression policy
         try:
-            # Check if a policy already exists to avoid errors on re-runs.
-            # This is a bit more complex as there isn't a simple IF NOT EXISTS for add_compression_policy.
-            # We'll attempt to add it; if it fails because it exists, we can log it as a warning.
-            cur.execute("""
-            SELECT add_compression_policy('channel_user_status', INTERVAL '1 days', if_not_exists => TRUE);
-            """)
+            cur.execute(COMPRESSION_POLICY_SQL)
             logging.info("Compression policy added or already exists for 'channel_user_status'.")
         except psycopg.Error as e:
             # A common error if the policy exists is '42710' (duplicate_object)
             if e.diag.sqlstate == '42710' or 'already has a compression policy' in str(e).lower():
-                logging.info(f"Compression policy for 'channel_user_status' already exists.")
+                logging.info("Compression policy for 'channel_user_status' already exists.")
             else:
-                logging.warning(f"Could not add compression policy: {e}")
-                conn.rollback() # Rollback on error
+                logging.warning("Could not add compression policy: %s", e)
+                complete = False
 
-        conn.commit()
+    return complete
 
-def get_all_channel_members(driver, channel_id):
-    page = 0
+INSERT_COLUMNS = "timestamp, team_id, team_name, channel_id, channel_name, user_id, username, status"
+
+INSERT_TYPES = ['timestamptz', 'text', 'text', 'text', 'text', 'text', 'text', 'text']
+
+def insert_records_copy(conn, rows):
+    # Binary COPY skips text formatting and escaping of every value
+    with conn.cursor() as cur:
+        with cur.copy(f"COPY channel_user_status ({INSERT_COLUMNS}) FROM STDIN (FORMAT BINARY)") as cp:
+            cp.set_types(INSERT_TYPES)
+            for row in rows:
+                cp.write_row(row)
+
+def insert_records_values(conn, rows):
+    # Bind each chunk into a single multi-row INSERT, so the server round-trips
+    # once per chunk instead of once per row. Full chunks share one statement
+    # shape, which is prepared on first use so later chunks skip parsing.
+    with conn.cursor() as cur:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == INSERT_CHUNK_SIZE:
+                insert_values_chunk(cur, chunk, prepare=True)
+                chunk = []
+        if chunk:
+            insert_values_chunk(cur, chunk, prepare=False)
+
+@functools.lru_cache(maxsize=None)
+def values_insert_sql(n_rows):
+    placeholders = ",".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * n_rows)
+    return f"INSERT INTO channel_user_status ({INSERT_COLUMNS}) VALUES {placeholders}"
+
+def insert_values_chunk(cur, chunk, prepare):
+    params = [value for row in chunk for value in row]
+    cur.execute(values_insert_sql(len(chunk)), params, prepare=prepare)
+
+def chunked(seq, n):
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+async def post_user_ids_in_chunks(client, path, user_ids_list, description):
+    # Large id lists can be rejected or handled slowly by the server, so post
+    # them in small chunks and merge the results.
+    semaphore = asyncio.Semaphore(USER_ID_CHUNK_CONCURRENCY)
+
+    async def post_chunk(chunk):
+        async with semaphore:
+            return await client.request('POST', path, json=chunk)
+
+    chunks = list(chunked(user_ids_list, USER_ID_CHUNK_SIZE))
+    results = await asyncio.gather(*[post_chunk(chunk) for chunk in chunks], return_exceptions=True)
+
+    merged = []
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            # Continue without this chunk, so 'unknown' will be used for its users
+            logging.error("Error fetching %s for %d users: %s", description, len(chunk), result)
+        else:
+            merged.extend(result)
+    return merged
+
+async def get_channel_members_page(client, channel_id, page, per_page):
+    return await client.request('GET', f"/channels/{channel_id}/members", params={'page': page, 'per_page': per_page})
+
+async def get_all_channel_members(client, channel_id):
     per_page = 200
     all_members = []
+    page = 0
+
+    # Use the member count to request all pages at once instead of walking
+    # them one round-trip at a time.
+    try:
+        stats = await client.request('GET', f"/channels/{channel_id}/stats")
+        n_pages = (stats['member_count'] + per_page - 1) // per_page
+    except Exception as e:
+        logging.debug("Could not fetch stats for channel %s, paging serially: %s", channel_id, e)
+        n_pages = 0
+
+    if n_pages:
+        pages = await asyncio.gather(*[get_channel_members_page(client, channel_id, p, per_page) for p in range(n_pages)])
+        for members in pages:
+            all_members.extend(members)
+        # The count may be stale; only keep paging if the last page was full
+        if len(pages[-1]) < per_page:
+            return all_members
+        page = n_pages
+
     while True:
-        members = driver.channels.get_channel_members(channel_id, params={'page': page, 'per_page': per_page})
+        members = await get_channel_members_page(client, channel_id, page, per_page)
         if not members:
             break
         all_members.extend(members)
         page += 1
-        time.sleep(API_DELAY)  # Configurable delay
     return all_members
 
-def main():
-    logging.info("Starting Mattermost online user collection script.")
-    driver = get_mattermost_driver()
-    driver.login()
-    logging.info("Logged in to Mattermost as %s", MM_USER)
-    teams = driver.teams.get_user_teams(driver.client.userid)
-    logging.info("Found %d teams.", len(teams))
-
-    now = datetime.now(timezone.utc)
-
-    all_user_ids_globally = set()
-    records_to_process_later = []
-
-    for team in teams:
-        team_id = team['id']
-        team_name = team['name']
-        logging.info(f"Processing team: {team_name} ({team_id})")
+async def get_team_channels(client, team):
+    team_id = team['id']
+    team_name = team['name']
+    logging.info("Processing team: %s (%s)", team_name, team_id)
+    try:
+        channels = await client.request('GET', f"/users/{client.user_id}/teams/{team_id}/channels")
+        logging.info("Found %d channels in team %s.", len(channels), team_name)
+        return channels
+    except Exception as e:
+        logging.error("Error fetching channels for team %s (%s): %s", team_id, team_name, e)
+        return [] # Skip team if channels can't be fetched
+
+async def get_channel_user_ids(client, team_name, channel_id, channel_name):
+    logging.debug("Processing channel: %s (%s) in team %s", channel_name, channel_id, team_name)
+    try:
+        members = await get_all_channel_members(client, channel_id)
+    except Exception as e:
+        logging.error("Error processing channel %s (%s): %s", channel_id, channel_name, e)
+        return set() # Skip channel
+
+    channel_user_ids = {member['user_id'] for member in members}
+    if not channel_user_ids:
+        logging.debug("No members found in channel %s (%s).", channel_name, channel_id)
+    return channel_user_ids
+
+async def collect_records():
+    # Phase 1: gather everything from Mattermost before touching the database,
+    # so the database connection is only held for the write phase.
+    timeout = aiohttp.ClientTimeout(total=30)
+    # A single session and connector for the whole run, so TCP/TLS connections
+    # are pooled and reused across all API calls instead of re-handshaking.
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENCY,
+        limit_per_host=MAX_CONCURRENCY,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=300,
+    )
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        client = MattermostClient(session, get_mattermost_api_url())
+        await client.login()
+        logging.info("Logged in to Mattermost as %s", MM_USER)
         try:
-            channels = driver.channels.get_channels_for_user(driver.client.userid, team_id)
-            logging.info(f"Found {len(channels)} channels in team {team_name}.")
-        except Exception as e:
-            logging.error(f"Error fetching channels for team {team_id} ({team_name}): {e}")
-            continue # Skip to next team if channels can't be fetched
-
-        for channel in channels:
-            channel_id = channel['id']
-            # Use display_name if available, otherwise name, finally 'unknown'
-            channel_name = channel.get('display_name') or channel.get('name', 'unknown')
-            logging.debug(f"Processing channel: {channel_name} ({channel_id}) in team {team_name}")
+            teams = await client.request('GET', f"/users/{client.user_id}/teams")
+            logging.info("Found %d teams.", len(teams))
+
+            all_user_ids_globally = set()
+            # (team_id, channel_id) -> set of member user_ids; names are kept once per id below
+            channel_membership = {}
+            team_name_by_id = {team['id']: team['name'] for team in teams}
+            channel_name_by_id = {}
+
+            channels_per_team = await asyncio.gather(*[get_team_channels(client, team) for team in teams])
+
+            # Direct and group message channels are listed again for every team,
+            # so resolve each channel's name and members only once per id.
+            team_ids_by_channel_id = {}
+            for team, channels in zip(teams, channels_per_team):
+                for channel in channels:
+                    channel_id = channel['id']
+                    if channel_id not in channel_name_by_id:
+                        # Use display_name if available, otherwise name, finally 'unknown'
+                        channel_name_by_id[channel_id] = channel.get('display_name') or channel.get('name', 'unknown')
+                        team_ids_by_channel_id[channel_id] = []
+                    team_ids_by_channel_id[channel_id].append(team['id'])
+
+            user_ids_per_channel = await asyncio.gather(*[
+                get_channel_user_ids(client, team_name_by_id[team_ids[0]], channel_id, channel_name_by_id[channel_id])
+                for channel_id, team_ids in team_ids_by_channel_id.items()
+            ])
+
+            for (channel_id, team_ids), channel_user_ids in zip(team_ids_by_channel_id.items(), user_ids_per_channel):
+                if channel_user_ids:
+                    all_user_ids_globally.update(channel_user_ids)
+                    for team_id in team_ids:
+                        channel_membership[(team_id, channel_id)] = channel_user_ids
+
+            user_id_to_username = {}
+            user_id_to_status = {}
+
+            if all_user_ids_globally:
+                user_ids_list = list(all_user_ids_globally)
+                logging.info("Fetching statuses and user details for %d unique users.", len(user_ids_list))
+                # Statuses and user details are independent, so fetch them concurrently
+                statuses_list, users_list = await asyncio.gather(
+                    post_user_ids_in_chunks(client, '/users/status/ids', user_ids_list, "user statuses"),
+                    post_user_ids_in_chunks(client, '/users/ids', user_ids_list, "user details"),
+                )
+
+                user_id_to_status = {status['user_id']: status['status'] for status in statuses_list}
+                user_id_to_username = {user['id']: user['username'] for user in users_list}
+                logging.info("Finished fetching statuses and user details.")
+        finally:
             try:
-                members = get_all_channel_members(driver, channel_id)
-                channel_user_ids = {member['user_id'] for member in members}
-
-                if not channel_user_ids:
-                    logging.debug(f"No members found in channel {channel_name} ({channel_id}).")
-                    continue
-
-                all_user_ids_globally.update(channel_user_ids)
-                for user_id in channel_user_ids:
-                    records_to_process_later.append(
-                        (now, team_id, team_name, channel_id, channel_name, user_id)
-                    )
+                await client.logout()
             except Exception as e:
-                logging.error(f"Error processing channel {channel_id} ({channel_name}): {e}")
-                continue # Skip to next channel
-
-    user_id_to_username = {}
-    user_id_to_status = {}
+                logging.warning("Could not log out from Mattermost: %s", e)
+
+    return channel_membership, team_name_by_id, channel_name_by_id, user_id_to_username, user_id_to_status
+
+def write_records(conn, now, channel_membership, team_name_by_id, channel_name_by_id,
+                  user_id_to_username, user_id_to_status):
+    # Phase 2: one schema check, then stream every row in a single explicit transaction
+    ensure_table_exists(conn)
+    record_count = sum(len(user_ids) for user_ids in channel_membership.values())
+    logging.info("Preparing to insert %d records.", record_count)
+
+    # Build the per-user and per-channel parts of each row once, so emitting a
+    # row is a single tuple concatenation.
+    user_fields = {}
+    for user_ids in channel_membership.values():
+        for user_id in user_ids:
+            if user_id not in user_fields:
+                user_fields[user_id] = (user_id, user_id_to_username.get(user_id, 'unknown'), user_id_to_status.get(user_id, 'unknown'))
+
+    def iter_rows():
+        for (team_id, channel_id), user_ids in channel_membership.items():
+            prefix = (now, team_id, team_name_by_id[team_id], channel_id, channel_name_by_id[channel_id])
+            for user_id in user_ids:
+                yield prefix + user_fields[user_id]
+
+    rows = iter_rows()
+    with conn.transaction():
+        if INSERT_MODE == 'values':
+            insert_records_values(conn, rows)
+        else:
+            insert_records_copy(conn, rows)
+
+    if record_count:
+        logging.info("Inserted %d records using %s mode.", record_count, INSERT_MODE)
+    else:
+        logging.info("No records were processed or inserted.")
 
-    if all_user_ids_globally:
-        user_ids_list = list(all_user_ids_globally)
-        logging.info(f"Fetching statuses and user details for {len(user_ids_list)} unique users.")
-        try:
-            statuses_list = driver.status.get_user_statuses_by_id(user_ids_list)
-            time.sleep(API_DELAY)  # Respect API delay between global calls
-            users_list = driver.users.get_users_by_ids(user_ids_list)
+def main():
+    logging.info("Starting Mattermost online user collection script.")
+    now = datetime.now(timezone.utc)
 
-            user_id_to_username = {user['id']: user['username'] for user in users_list}
-            user_id_to_status = {status['user_id']: status['status'] for status in statuses_list}
-            logging.info("Successfully fetched statuses and user details.")
-        except Exception as e:
-            logging.error(f"Error fetching global user statuses/details: {e}")
-            # Continue with empty maps, so 'unknown' will be used
+    records = asyncio.run(collect_records())
 
     with get_pg_conn() as conn:
-        ensure_table_exists(conn)
-        with conn.cursor() as cur:
-            processed_count = 0
-            logging.info(f"Preparing to insert {len(records_to_process_later)} records.")
-            for record_data in records_to_process_later:
-                r_now, r_team_id, r_team_name, r_channel_id, r_channel_name, r_user_id = record_data
-
-                username = user_id_to_username.get(r_user_id, 'unknown')
-                status = user_id_to_status.get(r_user_id, 'unknown')
+        write_records(conn, now, *records)
 
-                cur.execute(
-                    "INSERT INTO channel_user_status (timestamp, team_id, team_name, channel_id, channel_name, user_id, username, status) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-                    (r_now, r_team_id, r_team_name, r_channel_id, r_channel_name, r_user_id, username, status)
-                )
-                processed_count += 1
-                if processed_count % BATCH_SIZE == 0:
-                    conn.commit()
-                    logging.info(f"Committed batch of {BATCH_SIZE} records. Total processed: {processed_count}")
-
-            if processed_count > 0 and processed_count % BATCH_SIZE != 0:
-                conn.commit()
-                logging.info(f"Committed remaining {processed_count % BATCH_SIZE} records. Total processed: {processed_count}")
-            elif processed_count == 0:
-                logging.info("No records were processed or inserted.")
-
-    driver.logout()
     logging.info("Mattermost online user collection script finished.")
 
 